@@ -4,12 +4,18 @@ Script pour extraire les résultats d'une base SQLite de perplexité
 et afficher les phrases triées par perplexité décroissante.
 """
 
+import csv
 import sqlite3
 import argparse
 import os
+import sys
 from typing import List, Tuple, Optional
 
 
+# Nombre de lignes affichées par écriture sur la sortie standard
+PRINT_CHUNK_ROWS = 1000
+
+
 class PerplexityExtractor:
     def __init__(self, db_path: str):
         """Initialise l'extracteur avec le chemin de la base."""
@@ -18,32 +24,60 @@ class PerplexityExtractor:
             raise FileNotFoundError(f"La base de données {db_path} n'existe pas.")
         
         self.conn = sqlite3.connect(db_path)
-    
-    def get_statistics(self) -> dict:
-        """Récupère les statistiques de la base."""
-        cursor = self.conn.execute("SELECT COUNT(*) FROM sentences")
-        total_sentences = cursor.fetchone()[0]
         
-        cursor = self.conn.execute("SELECT COUNT(*) FROM sentences WHERE perplexity IS NOT NULL")
-        processed_sentences = cursor.fetchone()[0]
+        # Accès en lecture seule : cache de 64 Mio et lecture via mmap (256 Mio)
+        self.conn.execute("PRAGMA query_only=ON")
+        self.conn.execute("PRAGMA cache_size=-65536")
+        self.conn.execute("PRAGMA mmap_size=268435456")
         
-        cursor = self.conn.execute("""
-            SELECT AVG(perplexity), MIN(perplexity), MAX(perplexity) 
-            FROM sentences 
-            WHERE perplexity IS NOT NULL AND perplexity != 'inf'
-        """)
-        stats = cursor.fetchone()
+        # Index plein texte créé par perplexity_batch_processor.py (absent des anciennes bases)
+        self.has_fts = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sentences_fts'"
+        ).fetchone() is not None
         
-        cursor = self.conn.execute("SELECT COUNT(*) FROM sentences WHERE perplexity = 'inf'")
-        infinite_count = cursor.fetchone()[0]
+        # Base jamais migrée par perplexity_batch_processor.py (lecture seule ici) :
+        # pas de colonne processed, perplexité infinie stockée telle quelle
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(sentences)")}
+        self.has_processed = 'processed' in columns
+        if self.has_processed:
+            self.scored = "perplexity IS NOT NULL"
+        else:
+            self.scored = "perplexity IS NOT NULL AND perplexity < 9e999"
+        # Longueurs précalculées, sinon recalculées à la volée
+        if 'length' in columns:
+            self.length_expr, self.log_length_expr = "length", "log_length"
+        else:
+            self.length_expr, self.log_length_expr = "LENGTH(text)", "LOG(LENGTH(text))"
+    
+    def get_statistics(self) -> dict:
+        """Récupère les statistiques de la base."""
+        # Une seule passe d'agrégation ; perplexité infinie = traitée mais NULL
+        if self.has_processed:
+            query = """
+                SELECT COUNT(*), COALESCE(SUM(processed), 0),
+                       AVG(perplexity), MIN(perplexity), MAX(perplexity),
+                       COALESCE(SUM(processed = 1 AND perplexity IS NULL), 0)
+                FROM sentences
+            """
+        else:
+            query = """
+                SELECT COUNT(*), COUNT(perplexity),
+                       AVG(CASE WHEN perplexity < 9e999 THEN perplexity END),
+                       MIN(perplexity),
+                       MAX(CASE WHEN perplexity < 9e999 THEN perplexity END),
+                       COALESCE(SUM(perplexity = 9e999), 0)
+                FROM sentences
+            """
+        cursor = self.conn.execute(query)
+        total_sentences, processed_sentences, avg_perplexity, min_perplexity, max_perplexity, infinite_count = cursor.fetchone()
         
         return {
             'total': total_sentences,
             'processed': processed_sentences,
             'remaining': total_sentences - processed_sentences,
-            'avg_perplexity': stats[0] if stats[0] is not None else None,
-            'min_perplexity': stats[1] if stats[1] is not None else None,
-            'max_perplexity': stats[2] if stats[2] is not None else None,
+            'avg_perplexity': avg_perplexity,
+            'min_perplexity': min_perplexity,
+            'max_perplexity': max_perplexity,
             'infinite_count': infinite_count
         }
     
@@ -58,7 +92,7 @@ class PerplexityExtractor:
             min_perplexity: Perplexité minimale (filtre)
             max_perplexity: Perplexité maximale (filtre)
         """
-        query = "SELECT text, perplexity FROM sentences WHERE perplexity IS NOT NULL"
+        query = f"SELECT text, perplexity FROM sentences WHERE {self.scored}"
         params = []
         
         # Filtres
@@ -81,9 +115,56 @@ class PerplexityExtractor:
         cursor = self.conn.execute(query, params)
         return cursor.fetchall()
     
+    def get_sentences_page(self, page_size: int = 100,
+                           cursor_after: Optional[Tuple[float, int]] = None
+                           ) -> Tuple[List[Tuple[str, float]], Optional[Tuple[float, int]]]:
+        """
+        Récupère une page de phrases triées par perplexité décroissante.
+        
+        La pagination se fait par clé (perplexité, id) plutôt que par OFFSET :
+        chaque page reprend directement après la précédente dans l'index, sans
+        relire les lignes déjà renvoyées.
+        
+        Args:
+            page_size: Nombre de phrases par page
+            cursor_after: Jeton de reprise renvoyé par l'appel précédent
+                          (None pour la première page)
+            
+        Returns:
+            Tuple (phrases, jeton) où phrases est une liste de (text, perplexity)
+            et jeton le couple (perplexity, id) de la dernière ligne, à passer
+            en cursor_after pour la page suivante (None s'il n'y a plus de page)
+        """
+        query = f"SELECT id, text, perplexity FROM sentences WHERE {self.scored}"
+        params = []
+        
+        if cursor_after is not None:
+            last_perplexity, last_id = cursor_after
+            query += " AND (perplexity < ? OR (perplexity = ? AND id > ?))"
+            params.extend([last_perplexity, last_perplexity, last_id])
+        
+        query += " ORDER BY perplexity DESC, id ASC LIMIT ?"
+        params.append(page_size)
+        
+        rows = self.conn.execute(query, params).fetchall()
+        if len(rows) < page_size:
+            next_cursor = None
+        else:
+            last_id, _, last_perplexity = rows[-1]
+            next_cursor = (last_perplexity, last_id)
+        
+        return [(text, perplexity) for _, text, perplexity in rows], next_cursor
+    
     def get_top_perplexity_sentences(self, n: int = 10) -> List[Tuple[str, float]]:
         """Récupère les N phrases avec la plus haute perplexité."""
-        return self.get_sentences_by_perplexity(limit=n)
+        cursor = self.conn.execute(f"""
+            SELECT text, perplexity 
+            FROM sentences 
+            WHERE {self.scored}
+            ORDER BY perplexity DESC 
+            LIMIT ?
+        """, (n,))
+        return cursor.fetchall()
     
     def get_most_complex_sentences(self, n: int = 10, min_length: int = 50) -> List[Tuple[str, float, float]]:
         """
@@ -96,19 +177,15 @@ class PerplexityExtractor:
         Returns:
             Liste de tuples (text, perplexity, complexity_score)
         """
-        cursor = self.conn.execute("""
-            SELECT text, perplexity, LENGTH(text) as length,
-                   (perplexity * LOG(LENGTH(text))) as complexity_score
+        cursor = self.conn.execute(f"""
+            SELECT text, perplexity, perplexity * {self.log_length_expr} AS complexity_score
             FROM sentences 
-            WHERE perplexity IS NOT NULL 
-              AND perplexity != 'inf' 
-              AND LENGTH(text) >= ?
+            WHERE {self.scored} 
+              AND {self.length_expr} >= ?
             ORDER BY complexity_score DESC 
             LIMIT ?
         """, (min_length, n))
-        
-        results = cursor.fetchall()
-        return [(text, perplexity, complexity_score) for text, perplexity, length, complexity_score in results]
+        return cursor.fetchall()
     
     def get_sentences_by_complexity(self, limit: Optional[int] = None, 
                                    min_length: int = 30,
@@ -124,51 +201,80 @@ class PerplexityExtractor:
         Returns:
             Liste de tuples (text, perplexity, complexity_score)
         """
-        query = """
-            SELECT text, perplexity, LENGTH(text) as length,
-                   (perplexity * POWER(LENGTH(text), ?)) as complexity_score
+        # Poids 1.0 (cas par défaut) : score indexé, sans appel à POWER par ligne
+        if complexity_weight == 1.0:
+            score = f"perplexity * {self.length_expr}"
+            params = [min_length]
+        else:
+            score = f"perplexity * POWER({self.length_expr}, ?)"
+            params = [complexity_weight, min_length]
+        
+        query = f"""
+            SELECT text, perplexity, {score} AS complexity_score
             FROM sentences 
-            WHERE perplexity IS NOT NULL 
-              AND perplexity != 'inf' 
-              AND LENGTH(text) >= ?
+            WHERE {self.scored} 
+              AND {self.length_expr} >= ?
             ORDER BY complexity_score DESC
         """
-        params = [complexity_weight, min_length]
         
         if limit is not None:
             query += " LIMIT ?"
             params.append(limit)
         
         cursor = self.conn.execute(query, params)
-        results = cursor.fetchall()
-        return [(text, perplexity, complexity_score) for text, perplexity, length, complexity_score in results]
+        return cursor.fetchall()
     
     def get_bottom_perplexity_sentences(self, n: int = 10) -> List[Tuple[str, float]]:
         """Récupère les N phrases avec la plus faible perplexité."""
-        cursor = self.conn.execute("""
+        cursor = self.conn.execute(f"""
             SELECT text, perplexity 
             FROM sentences 
-            WHERE perplexity IS NOT NULL AND perplexity != 'inf'
+            WHERE {self.scored}
             ORDER BY perplexity ASC 
             LIMIT ?
         """, (n,))
         return cursor.fetchall()
     
     def search_sentences(self, keyword: str, case_sensitive: bool = False) -> List[Tuple[str, float]]:
-        """Recherche des phrases contenant un mot-clé."""
-        if case_sensitive:
+        """
+        Recherche des phrases contenant un mot-clé.
+        
+        Utilise l'index FTS5 quand il existe : le mot-clé est cherché comme préfixe
+        de mot, sans tenir compte de la casse ni des accents. En mode sensible à la
+        casse, les candidats FTS sont ensuite filtrés sur la sous-chaîne exacte.
+        """
+        # Sans caractère alphanumérique, le mot-clé ne produit aucun token FTS
+        if self.has_fts and any(c.isalnum() for c in keyword):
+            # Phrase FTS5 entre guillemets : neutralise la syntaxe MATCH du mot-clé
+            fts_query = '"' + keyword.replace('"', '""') + '"*'
             query = """
+                SELECT s.text, s.perplexity 
+                FROM sentences_fts f 
+                JOIN sentences s ON s.id = f.rowid
+                WHERE sentences_fts MATCH ? AND s.perplexity IS NOT NULL
+            """
+            params = [fts_query]
+            if case_sensitive:
+                query += " AND instr(s.text, ?) > 0"
+                params.append(keyword)
+            query += " ORDER BY s.perplexity DESC"
+            
+            cursor = self.conn.execute(query, params)
+            return cursor.fetchall()
+        
+        if case_sensitive:
+            query = f"""
                 SELECT text, perplexity 
                 FROM sentences 
-                WHERE text LIKE ? AND perplexity IS NOT NULL
+                WHERE text LIKE ? AND {self.scored}
                 ORDER BY perplexity DESC
             """
             pattern = f"%{keyword}%"
         else:
-            query = """
+            query = f"""
                 SELECT text, perplexity 
                 FROM sentences 
-                WHERE LOWER(text) LIKE LOWER(?) AND perplexity IS NOT NULL
+                WHERE LOWER(text) LIKE LOWER(?) AND {self.scored}
                 ORDER BY perplexity DESC
             """
             pattern = f"%{keyword}%"
@@ -177,33 +283,38 @@ class PerplexityExtractor:
         return cursor.fetchall()
     
     def export_to_text(self, output_path: str, format_type: str = "standard"):
-        """Exporte les résultats vers un fichier texte."""
-        sentences = self.get_sentences_by_perplexity()
+        """Exporte les résultats vers un fichier texte en parcourant le curseur ligne à ligne."""
+        cursor = self.conn.execute(f"""
+            SELECT text, perplexity 
+            FROM sentences 
+            WHERE {self.scored}
+            ORDER BY perplexity DESC
+        """)
         
         with open(output_path, 'w', encoding='utf-8') as f:
             if format_type == "standard":
                 f.write("PHRASES TRIÉES PAR PERPLEXITÉ DÉCROISSANTE\n")
                 f.write("=" * 80 + "\n\n")
                 
-                for sentence, perplexity in sentences:
-                    if perplexity == float('inf'):
-                        perp_str = "∞"
-                    else:
-                        perp_str = f"{perplexity:.2f}"
-                    f.write(f"{sentence} [[{perp_str}]]\n")
+                for sentence, perplexity in cursor:
+                    f.write(f"{sentence} [[{perplexity:.2f}]]\n")
             
             elif format_type == "csv":
                 f.write("sentence,perplexity\n")
-                for sentence, perplexity in sentences:
-                    # Échapper les guillemets dans le texte
-                    escaped_sentence = sentence.replace('"', '""')
-                    f.write(f'"{escaped_sentence}",{perplexity}\n')
+                # Phrases entre guillemets (guillemets internes doublés), perplexité brute
+                writer = csv.writer(f, quoting=csv.QUOTE_NONNUMERIC, lineterminator="\n")
+                writer.writerows(cursor)
             
             elif format_type == "json":
                 import json
-                data = [{"sentence": sentence, "perplexity": perplexity} 
-                       for sentence, perplexity in sentences]
-                json.dump(data, f, ensure_ascii=False, indent=2)
+                # Écriture incrémentale pour ne pas construire la liste complète en mémoire
+                f.write("[")
+                separator = "\n  "
+                for sentence, perplexity in cursor:
+                    f.write(separator)
+                    f.write(json.dumps({"sentence": sentence, "perplexity": perplexity}, ensure_ascii=False))
+                    separator = ",\n  "
+                f.write("\n]")
     
     def close(self):
         """Ferme la connexion à la base."""
@@ -242,24 +353,27 @@ def print_sentences(sentences, title: str = "RÉSULTATS", show_complexity: bool
     print(title)
     print(f"{'='*80}")
     
+    # Lignes accumulées puis écrites par paquets de PRINT_CHUNK_ROWS
+    write = sys.stdout.write
+    chunks = []
+    
     for i, item in enumerate(sentences, 1):
         if show_complexity and len(item) == 3:
             # Format avec score de complexité
             sentence, perplexity, complexity_score = item
-            if perplexity == float('inf'):
-                perp_str = "∞"
-            else:
-                perp_str = f"{perplexity:.2f}"
-            print(f"{i:3d}. {sentence}")
-            print(f"     [Perplexité: {perp_str}, Complexité: {complexity_score:.1f}, Longueur: {len(sentence)}]")
+            chunks.append(f"{i:3d}. {sentence}\n"
+                          f"     [Perplexité: {perplexity:.2f}, Complexité: {complexity_score:.1f}, Longueur: {len(sentence)}]\n")
         else:
             # Format standard
             sentence, perplexity = item[:2]
-            if perplexity == float('inf'):
-                perp_str = "∞"
-            else:
-                perp_str = f"{perplexity:.2f}"
-            print(f"{i:3d}. {sentence} [[{perp_str}]]")
+            chunks.append(f"{i:3d}. {sentence} [[{perplexity:.2f}]]\n")
+        
+        if len(chunks) >= PRINT_CHUNK_ROWS:
+            write("".join(chunks))
+            chunks.clear()
+    
+    write("".join(chunks))
+    sys.stdout.flush()
 
 
 def main():
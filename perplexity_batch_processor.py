@@ -8,86 +8,242 @@ import re
 import math
 import sqlite3
 import os
-import time
 import mlx.core as mx
 from mlx_lm import load
-from typing import List, Tuple, Optional
+from mlx_lm.models.cache import make_prompt_cache
+from typing import Iterable, List, Tuple, Optional
 import argparse
 from pathlib import Path
+from tqdm import tqdm
+
+
+# Regroupement des phrases de longueurs voisines pour l'inférence par lots
+BUCKET_SIZE = 16
+BUCKET_MAX_RATIO = 1.25
+
+# Au-delà de ce nombre de tokens, une phrase est évaluée par tranches via le cache KV
+PREFILL_CHUNK = 512
+
+# Fin de phrase : ponctuation terminale suivie d'espaces ou de la fin du texte
+SENTENCE_END_RE = re.compile(r'[.!?]+(?:\s+|$)')
+
+
+def token_nll(logits: mx.array, targets: mx.array) -> mx.array:
+    """NLL des tokens cibles : logsumexp(logits) - logit cible.
+    
+    Équivaut à -log_softmax(logits)[cible] sans matérialiser la distribution
+    complète sur le vocabulaire. Le résultat est en float32 : avec des logits
+    bfloat16, sommes, moyennes et exp garderaient sinon 8 bits de mantisse.
+    """
+    target_logits = mx.take_along_axis(logits, targets[..., None], axis=-1).squeeze(-1)
+    return mx.logsumexp(logits, axis=-1).astype(mx.float32) - target_logits.astype(mx.float32)
+
+
+def sentence_row(sentence: str) -> Tuple[str, int, Optional[float]]:
+    """Colonnes précalculées d'une phrase : (texte, longueur, log10(longueur))."""
+    length = len(sentence)
+    return sentence, length, math.log10(length) if length > 0 else None
 
 
 class PerplexityBatchProcessor:
-    def __init__(self, model_name: str = "mlx-community/SmolLM3-3B-4bit", db_path: str = "perplexity_cache.db"):
-        """Initialise le processeur batch avec base SQLite."""
+    def __init__(self, model_name: str = "mlx-community/SmolLM3-3B-4bit", db_path: str = "perplexity_cache.db",
+                 dtype: str = "bfloat16"):
+        """Initialise le processeur batch avec base SQLite.
+        
+        dtype fixe le type des activations du modèle ("auto" garde celui du chargement).
+        """
         self.db_path = db_path
         self.model_name = model_name
+        self.dtype = dtype
         self.model = None
         self.tokenizer = None
         
+        # Résultats pas encore écrits dans la base (voir store_result)
+        self.batch_size = 100
+        self._pending_results = []
+        
         # Initialiser la base de données
         self.init_database()
         
     def init_database(self):
         """Initialise la base de données SQLite."""
         self.conn = sqlite3.connect(self.db_path)
+        
+        # WAL + synchronous=NORMAL : un fsync par checkpoint plutôt que par commit ;
+        # cache de 64 Mio pour garder les index chauds
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA temp_store=MEMORY")
+        self.conn.execute("PRAGMA cache_size=-65536")
+        
         self.conn.execute("""
             CREATE TABLE IF NOT EXISTS sentences (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 text TEXT UNIQUE NOT NULL,
                 perplexity REAL,
+                length INTEGER,
+                log_length REAL,
+                processed INTEGER NOT NULL DEFAULT 0,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
+        self.migrate_database()
         
         # Index pour les performances
         self.conn.execute("CREATE INDEX IF NOT EXISTS idx_sentences_text ON sentences (text)")
-        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_sentences_perplexity ON sentences (perplexity)")
+        # Index partiel des phrases notées, ordonné par (perplexité DESC, id) :
+        # sert la pagination par clé de PerplexityExtractor.get_sentences_page
+        self.conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_sentences_perplexity_scored ON sentences (perplexity DESC)
+            WHERE perplexity IS NOT NULL
+        """)
+        # Index couvrant : les requêtes (texte, perplexité) triées sont servies
+        # par l'index seul, sans relire chaque ligne dans la table
+        self.conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_sentences_perplexity_text ON sentences (perplexity DESC, text)
+            WHERE perplexity IS NOT NULL
+        """)
+        # Index partiel des phrases en attente : il se vide au fil du traitement
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_sentences_pending ON sentences (id) WHERE processed = 0")
+        # Index sur les scores de complexité (perplexité × log10(longueur) ou × longueur)
+        self.conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_sentences_complexity ON sentences ((perplexity * log_length))
+            WHERE perplexity IS NOT NULL
+        """)
+        self.conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_sentences_complexity_linear ON sentences ((perplexity * length))
+            WHERE perplexity IS NOT NULL
+        """)
+        
+        # Index plein texte (FTS5) pour la recherche par mot-clé
+        fts_exists = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sentences_fts'"
+        ).fetchone()
+        self.conn.executescript("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS sentences_fts USING fts5(
+                text, content='sentences', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            );
+            CREATE TRIGGER IF NOT EXISTS sentences_fts_ai AFTER INSERT ON sentences BEGIN
+                INSERT INTO sentences_fts (rowid, text) VALUES (new.id, new.text);
+            END;
+            CREATE TRIGGER IF NOT EXISTS sentences_fts_ad AFTER DELETE ON sentences BEGIN
+                INSERT INTO sentences_fts (sentences_fts, rowid, text) VALUES ('delete', old.id, old.text);
+            END;
+            CREATE TRIGGER IF NOT EXISTS sentences_fts_au AFTER UPDATE OF text ON sentences BEGIN
+                INSERT INTO sentences_fts (sentences_fts, rowid, text) VALUES ('delete', old.id, old.text);
+                INSERT INTO sentences_fts (rowid, text) VALUES (new.id, new.text);
+            END;
+        """)
+        if not fts_exists:
+            # Base existante : indexer les phrases déjà stockées
+            self.conn.execute("INSERT INTO sentences_fts (sentences_fts) VALUES ('rebuild')")
         
         self.conn.commit()
         print(f"Base de données initialisée : {self.db_path}")
     
+    def migrate_database(self):
+        """Met à niveau le schéma d'une base créée par une version antérieure."""
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(sentences)")}
+        
+        if 'length' not in columns:
+            self.conn.execute("ALTER TABLE sentences ADD COLUMN length INTEGER")
+            self.conn.execute("ALTER TABLE sentences ADD COLUMN log_length REAL")
+            rows = self.conn.execute("SELECT id, text FROM sentences").fetchall()
+            self.conn.executemany(
+                "UPDATE sentences SET length = ?, log_length = ? WHERE id = ?",
+                (sentence_row(text)[1:3] + (sentence_id,) for sentence_id, text in rows)
+            )
+        
+        if 'processed' not in columns:
+            # La perplexité infinie était stockée telle quelle : elle devient NULL
+            # avec processed = 1, et la colonne perplexity ne contient plus que des réels
+            self.conn.execute("ALTER TABLE sentences ADD COLUMN processed INTEGER NOT NULL DEFAULT 0")
+            self.conn.execute("UPDATE sentences SET processed = 1 WHERE perplexity IS NOT NULL")
+            self.conn.execute(
+                "UPDATE sentences SET perplexity = NULL WHERE perplexity IN (?, 'inf', 'Infinity')",
+                (math.inf,)
+            )
+        
+        if 'text_hash' in columns:
+            # L'empreinte ignorait les différences d'espacement : des phrases que le
+            # modèle ne note pas pareil ont pu recevoir le score d'une autre. Tout
+            # groupe de phrases de même empreinte est remis en attente
+            self.conn.execute("""
+                UPDATE sentences SET perplexity = NULL, processed = 0
+                WHERE text_hash IN (
+                    SELECT text_hash FROM sentences GROUP BY text_hash HAVING COUNT(*) > 1
+                )
+            """)
+            self.conn.execute("DROP INDEX IF EXISTS idx_sentences_text_hash")
+            try:
+                self.conn.execute("ALTER TABLE sentences DROP COLUMN text_hash")
+            except sqlite3.OperationalError:
+                pass  # SQLite < 3.35 : la colonne inutilisée reste en place
+        
+        # Index complet des anciennes bases : toutes les requêtes filtrent désormais
+        # "perplexity IS NOT NULL" et passent par les index partiels
+        self.conn.execute("DROP INDEX IF EXISTS idx_sentences_perplexity")
+        
+        self.conn.commit()
+    
     def load_model(self):
         """Charge le modèle MLX (fait paresseusement)."""
         if self.model is None:
             print(f"Chargement du modèle {self.model_name}...")
             self.model, self.tokenizer = load(self.model_name)
+            if self.dtype != "auto":
+                # Poids 4 bits inchangés ; échelles et activations dans le type choisi
+                self.model.set_dtype(getattr(mx, self.dtype))
             print("Modèle chargé avec succès.")
     
     def split_into_sentences(self, text: str) -> List[str]:
-        """Découpe le texte en phrases."""
+        """Découpe le texte en phrases (de plus de 5 caractères)."""
         text = text.strip()
-        sentence_endings = r'[.!?]+(?:\s+|$)'
-        sentences = re.split(sentence_endings, text)
-        sentences = [s.strip() for s in sentences if s.strip() and len(s.strip()) > 5]
+        sentences = []
+        last = 0
+        # Un seul parcours du texte : on ne découpe qu'entre deux fins de phrase
+        for match in SENTENCE_END_RE.finditer(text):
+            sentence = text[last:match.start()].strip()
+            if len(sentence) > 5:
+                sentences.append(sentence)
+            last = match.end()
+        
+        sentence = text[last:].strip()
+        if len(sentence) > 5:
+            sentences.append(sentence)
         return sentences
     
-    def store_sentences(self, sentences: List[str]):
-        """Stocke les phrases dans la base."""
-        for sentence in sentences:
-            try:
-                self.conn.execute(
-                    "INSERT OR IGNORE INTO sentences (text, perplexity) VALUES (?, NULL)",
-                    (sentence,)
+    def store_sentences(self, sentences: Iterable[str]):
+        """Stocke les phrases dans la base en une seule transaction."""
+        try:
+            with self.conn:
+                cursor = self.conn.executemany(
+                    "INSERT OR IGNORE INTO sentences (text, length, log_length) VALUES (?, ?, ?)",
+                    (sentence_row(sentence) for sentence in sentences)
                 )
-            except sqlite3.Error as e:
-                print(f"Erreur SQLite lors du stockage de '{sentence[:50]}...': {e}")
-                continue
+                inserted = cursor.rowcount
+        except sqlite3.Error as e:
+            print(f"Erreur SQLite lors du stockage des phrases : {e}")
+            return
         
-        self.conn.commit()
-        print(f"Stocké {len(sentences)} phrases dans la base de données.")
+        print(f"Stocké {inserted} nouvelles phrases dans la base de données.")
     
-    def get_pending_sentences(self) -> List[Tuple[int, str]]:
-        """Récupère les phrases pas encore traitées."""
-        cursor = self.conn.execute("""
+    def count_pending_sentences(self) -> int:
+        """Compte les phrases pas encore traitées."""
+        cursor = self.conn.execute("SELECT COUNT(*) FROM sentences WHERE processed = 0")
+        return cursor.fetchone()[0]
+    
+    def get_pending_sentences(self) -> sqlite3.Cursor:
+        """Renvoie un curseur sur les phrases pas encore traitées (id, texte), sans ordre particulier."""
+        return self.conn.execute("""
             SELECT id, text 
             FROM sentences 
-            WHERE perplexity IS NULL
-            ORDER BY id
+            WHERE processed = 0
         """)
-        return cursor.fetchall()
     
-    def calculate_perplexity(self, sentence: str, verbose: bool = False) -> float:
-        """Calcule la perplexité d'une phrase."""
+    def calculate_perplexity(self, sentence: str, verbose: bool = False) -> Optional[float]:
+        """Calcule la perplexité d'une phrase (None si elle est infinie ou incalculable)."""
         try:
             if verbose:
                 print(f"  Analyse: '{sentence[:50]}...'")
@@ -100,48 +256,37 @@ class PerplexityBatchProcessor:
             if len(tokens) < 2:
                 if verbose:
                     print("  Phrase trop courte")
-                return float('inf')
+                return None
             
-            # Calcul de la log-vraisemblance totale
-            total_nll = 0.0
-            num_predictions = 0
+            if len(tokens) > PREFILL_CHUNK:
+                # Phrase très longue : passes successives à travers le cache KV
+                nll = self.calculate_nll_cached(tokens)
+            else:
+                # Une seule passe sur toute la séquence : le masque causal garantit
+                # que la position i ne voit que tokens[:i+1]
+                ids = mx.array([tokens])
+                logits = self.model(ids)
+                nll = token_nll(logits[0, :-1, :], ids[0, 1:])
             
-            # Pour chaque position, on prédit le token suivant
-            for i in range(len(tokens) - 1):
-                context_tokens = tokens[:i+1]
-                target_token = tokens[i+1]
-                
-                # Conversion en tenseurs MLX
-                context_ids = mx.array([context_tokens])
-                
-                # Forward pass
-                logits = self.model(context_ids)
-                
-                # Logits pour le dernier token du contexte
-                last_logits = logits[0, -1, :]
-                
-                # Calcul des probabilités
-                probs = mx.softmax(last_logits, axis=0)
-                
-                # Probabilité du token cible
-                target_prob = float(probs[target_token])
-                
-                if target_prob > 0 and not math.isinf(target_prob) and not math.isnan(target_prob):
-                    nll = -math.log(target_prob)
-                    total_nll += nll
-                    num_predictions += 1
-                    if verbose:
-                        print(f"    Pos {i}: token {target_token}, prob={target_prob:.6f}, nll={nll:.4f}")
-                else:
-                    if verbose:
-                        print(f"    Pos {i}: token {target_token}, prob invalide: {target_prob}")
-                    total_nll += 20.0
-                    num_predictions += 1
+            # Les positions invalides (inf/nan) comptent pour une NLL de 20.0
+            valid = mx.logical_not(mx.isnan(nll) | mx.isinf(nll))
+            nll = mx.where(valid, nll, 20.0)
+            mx.eval(nll, valid)
+            
+            total_nll = float(nll.sum())
+            num_predictions = nll.shape[0]
+            
+            if verbose:
+                for i, (target_token, nll_val, ok) in enumerate(zip(tokens[1:], nll.tolist(), valid.tolist())):
+                    if ok:
+                        print(f"    Pos {i}: token {target_token}, prob={math.exp(-nll_val):.6f}, nll={nll_val:.4f}")
+                    else:
+                        print(f"    Pos {i}: token {target_token}, prob invalide")
             
             if num_predictions == 0:
                 if verbose:
                     print("  Aucune prédiction valide")
-                return float('inf')
+                return None
             
             # Perplexité moyenne
             avg_nll = total_nll / num_predictions
@@ -155,56 +300,156 @@ class PerplexityBatchProcessor:
         except Exception as e:
             if verbose:
                 print(f"  ERREUR: {e}")
-            return float('inf')
+            return None
+    
+    def calculate_nll_cached(self, tokens: List[int]) -> mx.array:
+        """Calcule la NLL de chaque position par tranches de PREFILL_CHUNK tokens.
+        
+        Chaque tranche ne consomme que ses nouveaux tokens, le préfixe étant lu
+        dans le cache KV : le calcul reste exact tout en bornant les logits
+        matérialisés à [PREFILL_CHUNK, vocab].
+        """
+        cache = make_prompt_cache(self.model)
+        ids = mx.array(tokens)
+        chunks = []
+        
+        for start in range(0, len(tokens) - 1, PREFILL_CHUNK):
+            end = min(start + PREFILL_CHUNK, len(tokens) - 1)
+            logits = self.model(ids[None, start:end], cache=cache)
+            nll = token_nll(logits[0], ids[start + 1:end + 1])
+            # Évaluer chaque tranche libère ses logits avant la suivante
+            mx.eval(nll)
+            chunks.append(nll)
+        
+        return mx.concatenate(chunks)
+    
+    def calculate_perplexity_batch(self, token_lists: List[List[int]]) -> List[Optional[float]]:
+        """Calcule la perplexité de plusieurs phrases tokenisées en une seule passe.
+        
+        Les séquences sont complétées à droite jusqu'à la longueur maximale du lot ;
+        les positions de remplissage sont masquées dans la somme des NLL.
+        Une perplexité infinie est renvoyée sous la forme None.
+        """
+        lengths = [len(tokens) for tokens in token_lists]
+        max_len = max(lengths)
+        pad_id = getattr(self.tokenizer, 'pad_token_id', None) or 0
+        padded = [tokens + [pad_id] * (max_len - len(tokens)) for tokens in token_lists]
+        
+        ids = mx.array(padded)
+        logits = self.model(ids)
+        nll = token_nll(logits[:, :-1, :], ids[:, 1:])
+        
+        # Positions invalides -> 20.0, positions de remplissage -> 0
+        nll = mx.where(mx.isnan(nll) | mx.isinf(nll), 20.0, nll)
+        lengths_arr = mx.array(lengths)
+        mask = mx.arange(max_len - 1)[None, :] < (lengths_arr[:, None] - 1)
+        nll = mx.where(mask, nll, 0.0)
+        
+        perplexities = mx.exp(nll.sum(axis=1) / (lengths_arr - 1))
+        mx.eval(perplexities)
+        return [None if math.isinf(perplexity) else perplexity for perplexity in perplexities.tolist()]
     
-    def store_result(self, sentence_id: int, perplexity: float):
-        """Stocke le résultat dans la base."""
+    def make_buckets(self, items: List[Tuple[int, str, List[int]]]) -> List[List[Tuple[int, str, List[int]]]]:
+        """Regroupe les phrases (id, texte, tokens) par longueurs voisines."""
+        buckets = []
+        current = []
+        for item in sorted(items, key=lambda item: len(item[2])):
+            if current and (len(current) >= BUCKET_SIZE
+                            or len(item[2]) > len(current[0][2]) * BUCKET_MAX_RATIO):
+                buckets.append(current)
+                current = []
+            current.append(item)
+        if current:
+            buckets.append(current)
+        return buckets
+    
+    def store_result(self, sentence_id: int, perplexity: Optional[float]):
+        """Met un résultat en attente ; la base est écrite tous les batch_size résultats."""
+        self._pending_results.append((perplexity, sentence_id))
+        if len(self._pending_results) >= self.batch_size:
+            self.flush_results()
+    
+    def flush_results(self):
+        """Écrit les résultats en attente dans la base en une seule transaction."""
+        if not self._pending_results:
+            return
+        
         try:
-            self.conn.execute(
-                "UPDATE sentences SET perplexity = ? WHERE id = ?",
-                (perplexity, sentence_id)
-            )
-            self.conn.commit()
+            with self.conn:
+                self.conn.executemany(
+                    "UPDATE sentences SET perplexity = ?, processed = 1 WHERE id = ?",
+                    self._pending_results
+                )
         except sqlite3.Error as e:
-            print(f"Erreur lors du stockage du résultat pour sentence_id {sentence_id}: {e}")
+            print(f"Erreur lors du stockage de {len(self._pending_results)} résultats : {e}")
+        
+        self._pending_results.clear()
     
-    def process_batch(self, verbose: bool = False, batch_size: int = 100):
-        """Traite un lot de phrases en attente."""
-        # Charger le modèle seulement si nécessaire
-        self.load_model()
+    def score_sentences(self, rows: List[Tuple[int, str]]) -> List[Tuple[int, Optional[float]]]:
+        """Calcule la perplexité de phrases (id, texte) par lots de longueurs voisines."""
+        # Tokenisation puis regroupement par longueurs voisines (les textes sont
+        # uniques dans la base : chaque phrase est évaluée par le modèle)
+        items = []
+        results = []
+        for sentence_id, sentence in rows:
+            tokens = self.tokenizer.encode(sentence)
+            if len(tokens) < 2:
+                results.append((sentence_id, None))
+            elif len(tokens) > PREFILL_CHUNK:
+                # Trop longue pour un lot : traitée seule via le cache KV
+                results.append((sentence_id, self.calculate_perplexity(sentence)))
+            else:
+                items.append((sentence_id, sentence, tokens))
         
-        pending = self.get_pending_sentences()
+        for bucket in self.make_buckets(items):
+            try:
+                perplexities = self.calculate_perplexity_batch([tokens for _, _, tokens in bucket])
+            except Exception:
+                # Repli phrase par phrase si le lot échoue (mémoire, etc.)
+                perplexities = [self.calculate_perplexity(sentence) for _, sentence, _ in bucket]
+            
+            results.extend((sentence_id, perplexity)
+                           for (sentence_id, _, _), perplexity in zip(bucket, perplexities))
+        
+        return results
+    
+    def process_batch(self, verbose: bool = False, batch_size: int = 100):
+        """Traite les phrases en attente, avec un commit tous les batch_size résultats."""
+        total_pending = self.count_pending_sentences()
         
-        if not pending:
+        if not total_pending:
             print("Aucune phrase en attente de traitement.")
             return
         
-        total_pending = len(pending)
+        # Charger le modèle seulement si nécessaire
+        self.load_model()
+        
         print(f"\nTraitement de {total_pending} phrases en attente...")
         
+        self.batch_size = batch_size
         processed_count = 0
+        pending = self.get_pending_sentences()
         
-        for sentence_id, sentence in pending:
-            start_time = time.time()
-            
-            if verbose:
-                print(f"\n--- Phrase {processed_count + 1}/{total_pending} (ID: {sentence_id}) ---")
-            else:
-                print(f"  Phrase {processed_count + 1}/{total_pending}...", end=" ", flush=True)
-            
-            perplexity = self.calculate_perplexity(sentence, verbose)
-            
-            self.store_result(sentence_id, perplexity)
-            
-            if not verbose:
-                print(f"✓ ({perplexity:.2f})")
-            
-            processed_count += 1
-            
-            # Commit périodique pour éviter de perdre trop de données
-            if processed_count % batch_size == 0:
-                print(f"  → Sauvegarde intermédiaire ({processed_count}/{total_pending})")
+        # Barre de progression (désactivée en mode verbose, qui affiche ses propres détails)
+        with tqdm(total=total_pending, unit="phrase", disable=verbose) as progress:
+            while True:
+                rows = pending.fetchmany(batch_size)
+                if not rows:
+                    break
+                
+                if verbose:
+                    # Mode détaillé : une phrase à la fois avec le détail par token
+                    for sentence_id, sentence in rows:
+                        processed_count += 1
+                        print(f"\n--- Phrase {processed_count}/{total_pending} (ID: {sentence_id}) ---")
+                        self.store_result(sentence_id, self.calculate_perplexity(sentence, verbose))
+                else:
+                    for sentence_id, perplexity in self.score_sentences(rows):
+                        self.store_result(sentence_id, perplexity)
+                    processed_count += len(rows)
+                    progress.update(len(rows))
         
+        self.flush_results()
         print(f"\nTraitement terminé : {processed_count} phrases traitées.")
     
     def get_results_sorted(self) -> List[Tuple[str, float]]:
@@ -219,14 +464,12 @@ class PerplexityBatchProcessor:
     
     def print_statistics(self):
         """Affiche les statistiques du traitement."""
-        cursor = self.conn.execute("SELECT COUNT(*) FROM sentences")
-        total_sentences = cursor.fetchone()[0]
-        
-        cursor = self.conn.execute("SELECT COUNT(*) FROM sentences WHERE perplexity IS NOT NULL")
-        processed_sentences = cursor.fetchone()[0]
-        
-        cursor = self.conn.execute("SELECT AVG(perplexity), MIN(perplexity), MAX(perplexity) FROM sentences WHERE perplexity IS NOT NULL AND perplexity != 'inf'")
-        stats = cursor.fetchone()
+        cursor = self.conn.execute("""
+            SELECT COUNT(*), COALESCE(SUM(processed), 0),
+                   AVG(perplexity), MIN(perplexity), MAX(perplexity)
+            FROM sentences
+        """)
+        total_sentences, processed_sentences, *stats = cursor.fetchone()
         
         print(f"\n=== STATISTIQUES ===")
         print(f"Total phrases : {total_sentences}")
@@ -238,8 +481,9 @@ class PerplexityBatchProcessor:
             print(f"Perplexité min/max : {stats[1]:.2f} / {stats[2]:.2f}")
     
     def close(self):
-        """Ferme la connexion à la base."""
+        """Écrit les résultats en attente et ferme la connexion à la base."""
         if hasattr(self, 'conn'):
+            self.flush_results()
             self.conn.close()
 
 
@@ -251,13 +495,15 @@ def main():
     parser.add_argument('--model', '-m', type=str, default='mlx-community/SmolLM3-3B-4bit', help='Modèle MLX')
     parser.add_argument('--verbose', '-v', action='store_true', help='Mode verbose avec détails par token')
     parser.add_argument('--batch-size', '-b', type=int, default=100, help='Taille des lots pour sauvegarde')
+    parser.add_argument('--dtype', choices=['auto', 'bfloat16', 'float16', 'float32'], default='bfloat16',
+                        help='Type des activations du modèle (défaut: bfloat16, auto: type du modèle chargé)')
     parser.add_argument('--stats-only', '-s', action='store_true', help='Afficher uniquement les statistiques')
     parser.add_argument('--results-only', '-r', action='store_true', help='Afficher uniquement les résultats triés')
     
     args = parser.parse_args()
     
     # Initialiser le processeur
-    processor = PerplexityBatchProcessor(args.model, args.database)
+    processor = PerplexityBatchProcessor(args.model, args.database, args.dtype)
     
     try:
         if args.stats_only:
@@ -275,22 +521,14 @@ def main():
             print(f"{'='*80}")
             
             for sentence, perplexity in results:
-                if perplexity == float('inf'):
-                    perp_str = "∞"
-                else:
-                    perp_str = f"{perplexity:.2f}"
-                print(f"{sentence} [[{perp_str}]]")
+                print(f"{sentence} [[{perplexity:.2f}]]")
             
             if args.output:
                 with open(args.output, 'w', encoding='utf-8') as f:
                     f.write("PHRASES TRIÉES PAR PERPLEXITÉ DÉCROISSANTE\n")
                     f.write("="*80 + "\n")
                     for sentence, perplexity in results:
-                        if perplexity == float('inf'):
-                            perp_str = "∞"
-                        else:
-                            perp_str = f"{perplexity:.2f}"
-                        f.write(f"{sentence} [[{perp_str}]]\n")
+                        f.write(f"{sentence} [[{perplexity:.2f}]]\n")
                 print(f"\nRésultats sauvegardés dans {args.output}")
             
             return
@@ -326,6 +564,7 @@ def main():
         print(f"python {__file__} --database {args.database} --results-only")
         
     except KeyboardInterrupt:
+        processor.flush_results()
         print("\n\nInterruption détectée. Progression sauvegardée dans la base.")
         processor.print_statistics()
     except Exception as e:
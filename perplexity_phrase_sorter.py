@@ -5,36 +5,143 @@ Utilise MLX et SmolLM3-3B-4bit avec support de parallélisation.
 """
 
 import re
+import copy
 import math
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import mlx.core as mx
 from mlx_lm import load
-from typing import List, Tuple
+from mlx_lm.models.cache import make_prompt_cache
+from mlx_lm.tokenizer_utils import TokenizerWrapper
+from typing import List, Optional, Tuple
 import argparse
+from tqdm import tqdm
+
+try:
+    import pysbd
+except ImportError:
+    pysbd = None
+
+
+# Au-delà de ce nombre de tokens, une phrase est évaluée par tranches via le cache KV
+PREFILL_CHUNK = 512
+
+# Fenêtres glissantes pour les phrases hors contexte : taille et pas (en tokens)
+STRIDED_CTX = 2048
+STRIDED_STRIDE = 512
+
+# Au-delà de ce nombre de tokens, une phrase sort des lots et passe par les fenêtres glissantes
+MAX_SENT = 1024
+
+# Taille des groupes de quantification du cache KV (0 bit = cache non quantifié)
+KV_GROUP_SIZE = 64
+
+# NLL moyen au-delà duquel exp() déborde : la perplexité est affichée ∞
+MAX_EXP_NLL = 700.0
+
+# Nombre de phrases évaluées ensemble dans une passe paddée
+BATCH_SIZE = 8
+
+# Fins de phrase : ponctuation finale suivie d'un blanc ou de la fin du texte
+_SENT_RE = re.compile(r'[.!?]+(?:\s+|$)')
+_SENT_END_RE = re.compile(r'[.!?]+$')
+
+
+@partial(mx.compile, shapeless=True)
+def token_nll(logits: mx.array, targets: mx.array) -> mx.array:
+    """NLL de chaque token cible en une réduction et un gather.
+    
+    logits : [..., vocab_size], targets : [...] ; renvoie [...] en float32.
+    Compilée : logsumexp, gather et soustraction sont fusionnés en un seul
+    noyau. Compilation sans forme fixe : les longueurs de lot et de tranche
+    varient d'un appel à l'autre, seul un changement de rang retrace.
+    La réduction sur le vocabulaire garde le type des logits (bfloat16) ;
+    seuls les résultats par token passent en float32 pour les sommes.
+    """
+    target_logits = mx.take_along_axis(logits, targets[..., None], axis=-1).squeeze(-1)
+    return mx.logsumexp(logits, axis=-1).astype(mx.float32) - target_logits.astype(mx.float32)
+
+
+def finite_nll(avg_nll: float) -> float:
+    """NLL moyen, ou inf s'il n'est pas fini (nan ou -inf, p. ex. logits dégénérés en bfloat16).
+    
+    Un nan fausserait le tri : toute comparaison avec nan est fausse.
+    """
+    return avg_nll if math.isfinite(avg_nll) else float('inf')
+
+
+def nll_to_perplexity(avg_nll: float) -> float:
+    """Perplexité exp(NLL moyen), inf au-delà de la plage des flottants."""
+    return math.exp(avg_nll) if avg_nll < MAX_EXP_NLL else float('inf')
 
 
 class PerplexityCalculator:
-    def __init__(self, model_name: str = "mlx-community/SmolLM3-3B-4bit"):
-        """Initialise le calculateur de perplexité avec le modèle MLX."""
+    def __init__(self, model_name: str = "mlx-community/SmolLM3-3B-4bit", kv_bits: int = 8,
+                 dtype: str = "bfloat16"):
+        """Initialise le calculateur de perplexité avec le modèle MLX.
+        
+        kv_bits : précision du cache KV utilisé pour les phrases longues (0 = non quantifié).
+        dtype fixe le type des activations du modèle ("auto" garde celui du chargement).
+        """
+        self.kv_bits = kv_bits
+        # Segmenteur tenant compte des abréviations et décimales, si pysbd est installé
+        self.segmenter = pysbd.Segmenter(language="fr", clean=False) if pysbd else None
         print(f"Chargement du modèle {model_name}...")
         self.model, self.tokenizer = load(model_name)
+        if dtype != "auto":
+            # Poids 4 bits inchangés ; échelles, activations et logits dans le type choisi
+            self.model.set_dtype(getattr(mx, dtype))
+        
+        # La tokenisation groupée n'est rapide qu'avec le backend Rust (tokenizers)
+        if not getattr(self.tokenizer, 'is_fast', True):
+            try:
+                from transformers import AutoTokenizer
+                self.tokenizer = TokenizerWrapper(AutoTokenizer.from_pretrained(model_name, use_fast=True))
+            except Exception as e:
+                print(f"Tokenizer rapide indisponible, tokenizer par défaut conservé: {e}")
+        # Tokenizer Hugging Face sous-jacent, pour l'encodage groupé
+        self._hf_tokenizer = getattr(self.tokenizer, '_tokenizer', self.tokenizer)
         print("Modèle chargé avec succès.")
     
+    def make_cache(self) -> list:
+        """Crée le cache KV propre au modèle, quantifié sur kv_bits bits si demandé."""
+        cache = make_prompt_cache(self.model)
+        if not self.kv_bits:
+            return cache
+        return [c.to_quantized(group_size=KV_GROUP_SIZE, bits=self.kv_bits) for c in cache]
+    
     def split_into_sentences(self, text: str) -> List[str]:
-        """Découpe le texte en phrases."""
+        """Découpe le texte en phrases (pysbd si disponible, sinon expression régulière)."""
         text = text.strip()
-        sentence_endings = r'[.!?]+(?:\s+|$)'
-        sentences = re.split(sentence_endings, text)
+        if self.segmenter is not None:
+            # Même format que le repli : ponctuation finale retirée
+            sentences = [_SENT_END_RE.sub('', s.strip()) for s in self.segmenter.segment(text)]
+        else:
+            sentences = _SENT_RE.split(text)
         sentences = [s.strip() for s in sentences if s.strip()]
         return sentences
     
-    def calculate_perplexity_simple(self, sentence: str, verbose: bool = False) -> float:
-        """Calcule la perplexité d'une phrase avec une approche simplifiée."""
+    def tokenize(self, sentences: List[str]) -> List[List[int]]:
+        """Tokenise toutes les phrases en un seul appel au tokenizer."""
+        if not sentences:
+            return []
+        return self._hf_tokenizer(sentences)['input_ids']
+    
+    def calculate_nll_simple(self, sentence: str, verbose: bool = False,
+                             tokens: Optional[List[int]] = None) -> float:
+        """NLL moyen d'une phrase (logarithme de sa perplexité), inf si non calculable.
+        
+        Les tokens déjà calculés par tokenize() peuvent être fournis pour éviter
+        une seconde tokenisation.
+        """
         try:
             if verbose:
                 print(f"  Analyse: '{sentence[:50]}...'")
             
             # Tokenisation
-            tokens = self.tokenizer.encode(sentence)
+            if tokens is None:
+                tokens = self.tokenizer.encode(sentence)
             if verbose:
                 print(f"  Tokens ({len(tokens)}): {tokens[:10]}...")
             
@@ -43,55 +150,31 @@ class PerplexityCalculator:
                     print("  Phrase trop courte")
                 return float('inf')
             
-            # Calcul de la log-vraisemblance totale
-            total_nll = 0.0  # negative log likelihood
-            num_predictions = 0
-            
-            # Pour chaque position, on prédit le token suivant
-            for i in range(len(tokens) - 1):
-                context_tokens = tokens[:i+1]
-                target_token = tokens[i+1]
-                
-                # Conversion en tenseurs MLX
-                context_ids = mx.array([context_tokens])
-                
-                # Forward pass
-                logits = self.model(context_ids)
-                
-                # Logits pour le dernier token du contexte
-                last_logits = logits[0, -1, :]  # [vocab_size]
-                
-                # Calcul des probabilités
-                probs = mx.softmax(last_logits, axis=0)
-                
-                # Probabilité du token cible
-                target_prob = float(probs[target_token])
+            if len(tokens) > PREFILL_CHUNK:
+                # Phrase très longue : passes successives à travers le cache KV
+                avg_nll = finite_nll(self.calculate_nll_cached(tokens) / (len(tokens) - 1))
+                if verbose:
+                    print(f"  Évaluation par tranches de {PREFILL_CHUNK} tokens")
+            else:
+                # Une seule passe (teacher forcing) : le masque causal garantit que
+                # la position i ne voit que tokens[:i+1]
+                ids = mx.array([tokens])
+                logits = self.model(ids)
+                shift_logits = logits[0, :-1, :]  # [len-1, vocab_size]
+                targets = mx.array(tokens[1:])
+                nll = token_nll(shift_logits, targets)
+                mx.eval(nll)
                 
-                if target_prob > 0 and not math.isinf(target_prob) and not math.isnan(target_prob):
-                    nll = -math.log(target_prob)
-                    total_nll += nll
-                    num_predictions += 1
-                    if verbose:
-                        print(f"    Pos {i}: token {target_token}, prob={target_prob:.6f}, nll={nll:.4f}")
-                else:
-                    if verbose:
-                        print(f"    Pos {i}: token {target_token}, prob invalide: {target_prob}")
-                    total_nll += 20.0  # Valeur élevée pour prob très faible
-                    num_predictions += 1
-            
-            if num_predictions == 0:
                 if verbose:
-                    print("  Aucune prédiction valide")
-                return float('inf')
-            
-            # Perplexité moyenne
-            avg_nll = total_nll / num_predictions
-            perplexity = math.exp(avg_nll)
+                    for i, (target_token, nll_val) in enumerate(zip(tokens[1:], nll.tolist())):
+                        print(f"    Pos {i}: token {target_token}, prob={math.exp(-nll_val):.6f}, nll={nll_val:.4f}")
+                
+                avg_nll = finite_nll(float(nll.mean()))
             
             if verbose:
-                print(f"  Résultat: NLL moyen={avg_nll:.4f}, Perplexité={perplexity:.2f}")
+                print(f"  Résultat: NLL moyen={avg_nll:.4f}, Perplexité={nll_to_perplexity(avg_nll):.2f}")
             
-            return perplexity
+            return avg_nll
             
         except Exception as e:
             if verbose:
@@ -100,33 +183,281 @@ class PerplexityCalculator:
                 traceback.print_exc()
             return float('inf')
     
+    def calculate_perplexity_simple(self, sentence: str, verbose: bool = False,
+                                    tokens: Optional[List[int]] = None) -> float:
+        """Calcule la perplexité d'une phrase avec une approche simplifiée."""
+        return nll_to_perplexity(self.calculate_nll_simple(sentence, verbose, tokens))
+    
+    def calculate_nll_cached(self, tokens: List[int]) -> float:
+        """Somme des NLL d'une phrase, évaluée par tranches de PREFILL_CHUNK tokens.
+        
+        Chaque tranche ne consomme que ses nouveaux tokens, le préfixe étant lu dans
+        le cache KV : les logits matérialisés restent bornés. Le résultat est exact
+        avec kv_bits=0 ; avec un cache quantifié, il est approché (écart faible).
+        La somme reste sur le GPU ; une seule synchronisation a lieu en fin de boucle.
+        """
+        total_nll = self._nll_sum_cached(mx.array(tokens))
+        mx.eval(total_nll)
+        return float(total_nll)
+    
+    def _nll_sum_cached(self, ids: mx.array, first_target: int = 1) -> mx.array:
+        """Somme paresseuse des NLL des tokens ids[first_target:], par tranches via le cache KV.
+        
+        Les tokens qui précèdent first_target ne servent que de contexte.
+        """
+        cache = self.make_cache()
+        total_nll = mx.array(0.0)
+        
+        for start in range(0, ids.size - 1, PREFILL_CHUNK):
+            end = min(start + PREFILL_CHUNK, ids.size - 1)
+            logits = self.model(ids[None, start:end], cache=cache)
+            # La position p de la tranche prédit le token start + p + 1
+            skip = max(first_target - 1 - start, 0)
+            if skip < end - start:
+                nll = token_nll(logits[0, skip:], ids[start + 1 + skip:end + 1])
+                total_nll = total_nll + nll.sum()
+            # Lance le calcul de la tranche sans bloquer, pour que le graphe
+            # paresseux ne s'étende pas sur toute la phrase
+            mx.async_eval(total_nll, [c.state for c in cache])
+        
+        return total_nll
+    
+    def calculate_nll_strided(self, tokens: List[int], n_ctx: int = STRIDED_CTX,
+                              stride: int = STRIDED_STRIDE) -> float:
+        """NLL moyen approché d'une très longue séquence par fenêtres glissantes.
+        
+        Chaque fenêtre de n_ctx tokens avance de stride tokens et ne note que les
+        tokens pas encore notés, les précédents servant de contexte. Chaque fenêtre
+        est évaluée par tranches de PREFILL_CHUNK tokens via le cache KV : les logits
+        matérialisés restent bornés, et une séquence d'au plus n_ctx tokens est
+        évaluée d'une seule fenêtre, comme par calculate_nll_cached.
+        """
+        if not 0 < stride < n_ctx:
+            raise ValueError(f"Le pas ({stride}) doit être compris entre 1 et n_ctx - 1 ({n_ctx - 1})")
+        if len(tokens) < 2:
+            return float('inf')
+        
+        ids = mx.array(tokens)
+        total_nll = mx.array(0.0)
+        scored_end = 1  # le premier token n'est jamais prédit
+        
+        for begin in range(0, len(tokens), stride):
+            end = min(begin + n_ctx, len(tokens))
+            total_nll = total_nll + self._nll_sum_cached(ids[begin:end], scored_end - begin)
+            scored_end = end
+            if end == len(tokens):
+                break
+        
+        mx.eval(total_nll)
+        return finite_nll(float(total_nll) / (len(tokens) - 1))
+    
+    def calculate_perplexity_strided(self, tokens: List[int], n_ctx: int = STRIDED_CTX,
+                                     stride: int = STRIDED_STRIDE) -> float:
+        """Perplexité approchée d'une très longue séquence par fenêtres glissantes."""
+        return nll_to_perplexity(self.calculate_nll_strided(tokens, n_ctx, stride))
+    
+    def pad_batch(self, token_lists: List[List[int]],
+                  out: Optional[np.ndarray] = None) -> Tuple[List[int], Optional[np.ndarray], List[int]]:
+        """Prépare côté CPU l'entrée paddée d'un lot, sans appel à MLX.
+        
+        Renvoie les indices des phrases retenues (entre 2 et PREFILL_CHUNK tokens),
+        la matrice complétée à droite [B, L] et les longueurs réelles. Si out est
+        fourni et assez grand, la matrice est une vue sur ce tampon réutilisable.
+        """
+        batch = [i for i, tokens in enumerate(token_lists) if 2 <= len(tokens) <= PREFILL_CHUNK]
+        if not batch:
+            return batch, None, []
+        
+        lengths = [len(token_lists[i]) for i in batch]
+        pad_id = getattr(self.tokenizer, 'pad_token_id', None) or 0
+        shape = (len(batch), max(lengths))
+        if out is not None and out.shape[0] >= shape[0] and out.shape[1] >= shape[1]:
+            padded = out[:shape[0], :shape[1]]
+            padded.fill(pad_id)
+        else:
+            padded = np.full(shape, pad_id, dtype=np.int32)
+        for row, i in enumerate(batch):
+            padded[row, :lengths[row]] = token_lists[i]
+        return batch, padded, lengths
+    
+    def calculate_nll_batch(self, sentences: List[str],
+                            token_lists: Optional[List[List[int]]] = None,
+                            prepared: Optional[Tuple] = None) -> List[float]:
+        """NLL moyen de plusieurs phrases en une seule passe paddée.
+        
+        Les phrases trop courtes valent inf ; les phrases plus longues que
+        PREFILL_CHUNK tokens sont évaluées à part via le cache KV. prepared est
+        le résultat de pad_batch(token_lists) s'il a déjà été calculé.
+        """
+        if token_lists is None:
+            token_lists = self.tokenize(sentences)
+        results = [float('inf')] * len(sentences)
+        
+        for i, tokens in enumerate(token_lists):
+            if len(tokens) > PREFILL_CHUNK:
+                results[i] = self.calculate_nll_simple(sentences[i], tokens=tokens)
+        
+        batch, padded, lengths = prepared if prepared is not None else self.pad_batch(token_lists)
+        if not batch:
+            return results
+        
+        max_len = padded.shape[1]
+        ids = mx.array(padded)  # [B, L]
+        logits = self.model(ids)
+        nll = token_nll(logits[:, :-1, :], ids[:, 1:])
+        
+        # Les positions de remplissage sont exclues de la somme des NLL
+        lengths_arr = mx.array(lengths)
+        mask = mx.arange(max_len - 1)[None, :] < (lengths_arr[:, None] - 1)
+        avg_nll = mx.where(mask, nll, 0.0).sum(axis=1) / (lengths_arr - 1)
+        mx.eval(avg_nll)
+        
+        for i, value in zip(batch, avg_nll.tolist()):
+            results[i] = finite_nll(value)
+        return results
+    
+    def calculate_perplexity_batch(self, sentences: List[str],
+                                   token_lists: Optional[List[List[int]]] = None) -> List[float]:
+        """Calcule la perplexité de plusieurs phrases en une seule passe paddée."""
+        return [nll_to_perplexity(avg_nll) for avg_nll in self.calculate_nll_batch(sentences, token_lists)]
+    
+    def score_completions(self, prefix: str, completions: List[str]) -> List[float]:
+        """Perplexité de chaque complétion d'un même préfixe.
+        
+        Le préfixe est évalué une seule fois ; chaque complétion repart d'une copie
+        de son cache KV et n'évalue que ses propres tokens. Seuls les tokens de la
+        complétion entrent dans la perplexité. Un préfixe vide est remplacé par le
+        seul token BOS : chaque token de la complétion est alors noté, comme par
+        calculate_perplexity_simple sur la complétion seule.
+        """
+        if prefix:
+            prefix_tokens = self.tokenizer.encode(prefix)
+        else:
+            bos_id = getattr(self.tokenizer, 'bos_token_id', None)
+            if bos_id is None:
+                # Sans BOS, le premier token ne peut être prédit : notation phrase par phrase
+                return [self.calculate_perplexity_simple(completion) for completion in completions]
+            prefix_tokens = [bos_id]
+        
+        prefix_cache = self.make_cache()
+        logits = self.model(mx.array([prefix_tokens]), cache=prefix_cache)
+        last_logits = logits[0, -1:, :]  # prédit le premier token de la complétion
+        mx.eval(last_logits, [c.state for c in prefix_cache])
+        
+        results = []
+        for completion in completions:
+            tokens = self.tokenizer.encode(completion, add_special_tokens=False)
+            if not tokens:
+                results.append(float('inf'))
+                continue
+            
+            cache = copy.deepcopy(prefix_cache)
+            ids = mx.array(tokens)
+            logits = self.model(ids[None], cache=cache)
+            all_logits = mx.concatenate([last_logits, logits[0, :-1, :]], axis=0)
+            avg_nll = token_nll(all_logits, ids).mean()
+            results.append(nll_to_perplexity(float(avg_nll)))
+        
+        return results
+    
+    def _score_outlier(self, tokens: List[int]) -> float:
+        """NLL moyen d'une phrase de plus de MAX_SENT tokens (inf en cas d'erreur)."""
+        try:
+            return self.calculate_nll_strided(tokens)
+        except Exception:
+            return float('inf')
+    
     def process_text(self, text: str, verbose: bool = False) -> List[Tuple[str, float]]:
-        """Traite un texte complet et retourne les phrases avec leur perplexité."""
+        """Traite un texte complet et retourne les couples (phrase, NLL moyen).
+        
+        Attention : la valeur renvoyée est le NLL moyen, et non plus la perplexité.
+        Le NLL moyen est le logarithme de la perplexité : il ordonne les phrases de
+        la même façon sans déborder vers inf. nll_to_perplexity le convertit en
+        perplexité ; inf signale une phrase trop courte ou non calculable.
+        """
         sentences = self.split_into_sentences(text)
+        tokenized = self.tokenize(sentences)
         results = []
         
         print(f"\nTraitement de {len(sentences)} phrases...")
         if verbose:
             print("="*60)
         
-        # Traitement séquentiel (MLX n'est pas thread-safe)
-        for i, sentence in enumerate(sentences, 1):
-            if verbose:
+        # Traitement séquentiel des lots (MLX n'est pas thread-safe)
+        if verbose:
+            # Mode détaillé : une phrase à la fois avec le détail par token
+            for i, sentence in enumerate(sentences, 1):
                 print(f"\nPhrase {i}/{len(sentences)}:")
-            else:
-                print(f"  Phrase {i}/{len(sentences)}...", end=" ", flush=True)
+                tokens = tokenized[i - 1]
+                if len(tokens) > MAX_SENT:
+                    # Même évaluation qu'hors mode détaillé, pour des scores identiques
+                    print(f"  {len(tokens)} tokens : évaluation par fenêtres glissantes")
+                    avg_nll = self._score_outlier(tokens)
+                else:
+                    avg_nll = self.calculate_nll_simple(sentence, verbose, tokens)
+                results.append((sentence, avg_nll))
+            return results
+        
+        # Chaque phrase distincte n'est évaluée qu'une fois ; celles de moins de
+        # 2 tokens valent inf sans appel au modèle
+        unique = {}
+        for i, sentence in enumerate(sentences):
+            unique.setdefault(sentence, i)
+        to_score = [i for i in unique.values() if len(tokenized[i]) >= 2]
+        if len(to_score) < len(sentences):
+            print(f"  {len(to_score)} phrases distinctes à évaluer")
+        
+        # Lots formés de phrases de longueurs voisines pour limiter le remplissage ;
+        # les résultats sont replacés dans l'ordre du texte
+        # Les phrases hors norme passent par les fenêtres glissantes
+        order = sorted((i for i in to_score if len(tokenized[i]) <= MAX_SENT),
+                       key=lambda i: len(tokenized[i]))
+        outliers = [i for i in to_score if len(tokenized[i]) > MAX_SENT]
+        nlls = [float('inf')] * len(sentences)
+        chunks = [order[start:start + BATCH_SIZE] for start in range(0, len(order), BATCH_SIZE)]
+        
+        # Un thread prépare l'entrée paddée du lot suivant pendant que le GPU
+        # évalue le lot courant ; les appels au modèle restent séquentiels.
+        # Deux tampons alternés : celui du lot courant n'est jamais réécrit
+        # avant sa copie vers MLX
+        buffers = [np.empty((BATCH_SIZE, PREFILL_CHUNK), dtype=np.int32) for _ in range(2)]
+        with ThreadPoolExecutor(max_workers=1) as executor, \
+                tqdm(total=len(to_score), unit="phrase") as progress:
+            if chunks:
+                next_prepared = executor.submit(self.pad_batch, [tokenized[i] for i in chunks[0]],
+                                                buffers[0])
             
-            perplexity = self.calculate_perplexity_simple(sentence, verbose)
-            results.append((sentence, perplexity))
+            for n, indices in enumerate(chunks):
+                batch = [sentences[i] for i in indices]
+                batch_tokens = [tokenized[i] for i in indices]
+                prepared = next_prepared.result()
+                if n + 1 < len(chunks):
+                    next_prepared = executor.submit(self.pad_batch, [tokenized[i] for i in chunks[n + 1]],
+                                                    buffers[(n + 1) % 2])
+                
+                try:
+                    batch_nlls = self.calculate_nll_batch(batch, batch_tokens, prepared)
+                except Exception:
+                    # Repli phrase par phrase si le lot échoue (mémoire, etc.)
+                    batch_nlls = [self.calculate_nll_simple(sentence, tokens=tokens)
+                                  for sentence, tokens in zip(batch, batch_tokens)]
+                for i, avg_nll in zip(indices, batch_nlls):
+                    nlls[i] = avg_nll
+                
+                progress.update(len(batch))
             
-            if not verbose:
-                print("✓")
+            for i in outliers:
+                nlls[i] = self._score_outlier(tokenized[i])
+                progress.update(1)
         
-        return results
+        return [(sentence, nlls[unique[sentence]]) for sentence in sentences]
     
-    def sort_by_perplexity(self, sentence_perplexities: List[Tuple[str, float]]) -> List[Tuple[str, float]]:
-        """Trie les phrases par perplexité décroissante."""
-        return sorted(sentence_perplexities, key=lambda x: x[1], reverse=True)
+    def sort_by_perplexity(self, sentence_nlls: List[Tuple[str, float]]) -> List[Tuple[str, float]]:
+        """Trie les phrases par perplexité décroissante.
+        
+        exp étant croissante, le tri se fait directement sur le NLL moyen.
+        """
+        return sorted(sentence_nlls, key=lambda x: x[1], reverse=True)
 
 
 def main():
@@ -138,6 +469,10 @@ def main():
                         help='Nom du modèle MLX à utiliser')
     parser.add_argument('--verbose', '-v', action='store_true',
                         help='Afficher les détails d\'analyse par token')
+    parser.add_argument('--kv-bits', type=int, default=8, choices=[0, 4, 8],
+                        help='Bits du cache KV pour les phrases longues (0 = non quantifié)')
+    parser.add_argument('--dtype', choices=['auto', 'bfloat16', 'float16', 'float32'], default='bfloat16',
+                        help='Type des activations du modèle (défaut: bfloat16, auto: type du modèle chargé)')
     
     args = parser.parse_args()
     
@@ -152,13 +487,13 @@ def main():
         return
     
     # Initialisation du calculateur
-    calculator = PerplexityCalculator(args.model)
+    calculator = PerplexityCalculator(args.model, kv_bits=args.kv_bits, dtype=args.dtype)
     
     # Traitement du texte
-    sentence_perplexities = calculator.process_text(input_text, args.verbose)
+    sentence_nlls = calculator.process_text(input_text, args.verbose)
     
     # Tri par perplexité décroissante
-    sorted_sentences = calculator.sort_by_perplexity(sentence_perplexities)
+    sorted_sentences = calculator.sort_by_perplexity(sentence_nlls)
     
     # Génération du résultat
     result_lines = []
@@ -166,11 +501,10 @@ def main():
     result_lines.append("PHRASES TRIÉES PAR PERPLEXITÉ DÉCROISSANTE")
     result_lines.append("="*80)
     
-    for sentence, perplexity in sorted_sentences:
-        if perplexity == float('inf'):
-            perp_str = "∞"
-        else:
-            perp_str = f"{perplexity:.2f}"
+    for sentence, avg_nll in sorted_sentences:
+        # exp n'est appliquée qu'à l'affichage
+        perplexity = nll_to_perplexity(avg_nll)
+        perp_str = "∞" if math.isinf(perplexity) else f"{perplexity:.2f}"
         result_lines.append(f"{sentence} [[{perp_str}]]")
     
     result_text = '\n'.join(result_lines)
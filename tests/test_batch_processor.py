@@ -0,0 +1,41 @@
+"""Tests de perplexity_batch_processor.py (nécessitent MLX, donc Apple Silicon)."""
+
+import pytest
+
+pytest.importorskip("mlx.core")
+
+from perplexity_batch_processor import PerplexityBatchProcessor
+
+
+class CharTokenizer:
+    """Tokenizer minimal : un token par caractère, blancs compris."""
+    pad_token_id = 0
+    
+    def encode(self, text):
+        return [ord(c) % 255 + 1 for c in text]
+
+
+def test_sentences_differing_only_in_whitespace_are_each_scored(tmp_path):
+    processor = PerplexityBatchProcessor(db_path=str(tmp_path / "test.db"))
+    processor.model = object()  # load_model() ne charge rien
+    processor.tokenizer = CharTokenizer()
+    
+    scored = []
+    
+    def fake_batch(token_lists):
+        scored.extend(token_lists)
+        return [float(len(tokens)) for tokens in token_lists]
+    
+    processor.calculate_perplexity_batch = fake_batch
+    
+    spaced = "Une phrase  avec\n\ndes blancs"
+    compact = "Une phrase avec des blancs"
+    processor.store_sentences([spaced, compact])
+    processor.process_batch()
+    
+    tokenizer = CharTokenizer()
+    assert sorted(scored) == sorted([tokenizer.encode(spaced), tokenizer.encode(compact)])
+    results = dict(processor.get_results_sorted())
+    assert results[spaced] == len(spaced)
+    assert results[compact] == len(compact)
+    processor.close()
@@ -0,0 +1,65 @@
+"""Tests de perplexity_phrase_sorter.py (nécessitent MLX, donc Apple Silicon)."""
+
+import pytest
+
+mx = pytest.importorskip("mlx.core")
+nn = pytest.importorskip("mlx.nn")
+
+from mlx_lm.models.cache import KVCache
+
+from perplexity_phrase_sorter import PerplexityCalculator
+
+BOS_ID = 1
+VOCAB_SIZE = 40
+
+
+class CharTokenizer:
+    """Tokenizer minimal : BOS puis un token par caractère."""
+    bos_token_id = BOS_ID
+    pad_token_id = 0
+    
+    def encode(self, text, add_special_tokens=True):
+        tokens = [ord(c) % (VOCAB_SIZE - 2) + 2 for c in text]
+        return [BOS_ID] + tokens if add_special_tokens else tokens
+    
+    def __call__(self, texts):
+        return {'input_ids': [self.encode(text) for text in texts]}
+
+
+class BigramModel(nn.Module):
+    """Modèle jouet : les logits ne dépendent que du token courant."""
+    
+    def __init__(self):
+        super().__init__()
+        self.embedding = nn.Embedding(VOCAB_SIZE, VOCAB_SIZE)
+    
+    def __call__(self, inputs, cache=None):
+        logits = self.embedding(inputs)
+        if cache is not None:
+            # Le cache suit la position courante comme celui d'un vrai modèle
+            cache[0].update_and_fetch(logits[:, None], logits[:, None])
+        return logits
+    
+    def make_cache(self):
+        return [KVCache()]
+
+
+def make_calculator() -> PerplexityCalculator:
+    """Calculateur monté sur le modèle jouet, sans chargement depuis le Hub."""
+    calculator = PerplexityCalculator.__new__(PerplexityCalculator)
+    calculator.model = BigramModel()
+    calculator.tokenizer = CharTokenizer()
+    calculator._hf_tokenizer = calculator.tokenizer
+    calculator.kv_bits = 0
+    calculator.segmenter = None
+    return calculator
+
+
+def test_score_completions_with_empty_prefix_matches_simple_scoring():
+    calculator = make_calculator()
+    completions = ["abc", "une phrase un peu plus longue"]
+    
+    scores = calculator.score_completions("", completions)
+    
+    expected = [calculator.calculate_perplexity_simple(completion) for completion in completions]
+    assert scores == pytest.approx(expected, rel=1e-4)